@@ -11,23 +11,23 @@ class FillAndPour(Transport):
 
     def init_scene(self, scene: str = None, layout: int = None, room: int = None,
                    goal_room: int = None) -> ActionStatus:
-        origin = np.array([0, 0, 0])
         commands = [{"$type": "load_scene",
                      "scene_name": "ProcGenScene"},
                     TDWUtils.create_empty_room(12, 12)]
         self._add_container(model_name="basket_18inx18inx12iin",
                             position={"x": 0.354, "y": 0, "z": 0.549},
                             rotation={"x": 0, "y": -70, "z": 0})
-        # Add target objects in a circle.
+        # Add target objects in a circle. Compute all of the rotated positions in one pass.
         num_objects = 10
         d_theta = 360 / num_objects
-        theta = d_theta / 2
-        pos = np.array([2, 0, 0])
-        for j in range(num_objects):
-            object_position = TDWUtils.rotate_position_around(origin=origin, position=pos, angle=theta)
-            self._add_target_object("jug05",
-                                    position=TDWUtils.array_to_vector3(object_position))
-            theta += d_theta
+        r = 2.0
+        thetas = np.deg2rad(d_theta / 2 + d_theta * np.arange(num_objects))
+        xs = r * np.cos(thetas)
+        zs = r * np.sin(thetas)
+        # Build all of the position dicts in one pass.
+        positions = [{"x": float(xs[j]), "y": 0, "z": float(zs[j])} for j in range(num_objects)]
+        for position in positions:
+            self._add_target_object("jug05", position=position)
         commands.extend(self._get_scene_init_commands())
         resp = self.communicate(commands)
         self._cache_static_data(resp=resp)
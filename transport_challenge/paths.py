@@ -15,3 +15,5 @@ TARGET_OBJECTS_PATH = OBJECT_DATA_DIRECTORY.joinpath("target_objects.csv")
 TARGET_OBJECT_MATERIALS_PATH = OBJECT_DATA_DIRECTORY.joinpath("target_object_materials.txt")
 # The path to the list of containers.
 CONTAINERS_PATH = OBJECT_DATA_DIRECTORY.joinpath("containers.txt")
+# The path to precomputed arm angles for resetting an arm holding a container.
+CONTAINER_ARM_ANGLES_PATH = OBJECT_DATA_DIRECTORY.joinpath("container_arm_angles.json")
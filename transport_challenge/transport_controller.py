@@ -1,6 +1,7 @@
 from json import loads
 from csv import DictReader
-from typing import List, Dict, Tuple, Optional, Union
+from pathlib import Path
+from typing import List, Dict, Tuple, Set, Optional, Union
 import numpy as np
 from tdw.py_impact import ObjectInfo, AudioMaterial
 from tdw.librarian import ModelLibrarian
@@ -8,7 +9,16 @@ from tdw.tdw_utils import TDWUtils
 from magnebot import Magnebot, Arm, ActionStatus, ArmJoint
 from magnebot.scene_state import SceneState
 from magnebot.paths import ROOM_MAPS_DIRECTORY, OCCUPANCY_MAPS_DIRECTORY, SCENE_BOUNDS_PATH, SPAWN_POSITIONS_PATH
-from transport_challenge.paths import TARGET_OBJECT_MATERIALS_PATH, TARGET_OBJECTS_PATH, CONTAINERS_PATH
+from transport_challenge.paths import TARGET_OBJECT_MATERIALS_PATH, TARGET_OBJECTS_PATH, CONTAINERS_PATH, \
+    CONTAINER_ARM_ANGLES_PATH
+
+# Parse the scene bounds for every scene once at import rather than per scene reset.
+# orjson is much faster than the json module; fall back to the json module if it isn't installed.
+try:
+    from orjson import loads as _orjson_loads
+    _SCENE_BOUNDS: dict = _orjson_loads(SCENE_BOUNDS_PATH.read_bytes())
+except ImportError:
+    _SCENE_BOUNDS: dict = loads(SCENE_BOUNDS_PATH.read_text())
 
 
 class Transport(Magnebot):
@@ -80,11 +90,33 @@ class Transport(Magnebot):
     # The model librarian.
     __LIBRARIAN = ModelLibrarian()
 
+    # Cached model substructures. Key = model name. `ModelLibrarian.get_record()` is a linear scan.
+    __SUBSTRUCTURE_CACHE: Dict[str, list] = dict()
+
+    # Cached audio info for target objects. Key = model name. Only the name varies between objects.
+    __AUDIO_CACHE: Dict[str, ObjectInfo] = dict()
+
     # The value of the torso prismatic joint while the Magnebot is holding a container.
     __TORSO_PRISMATIC_CONTAINER = 1.2
 
+    # The path to the disk cache of container arm reset angles. Key = f"{arm.name}_{model_name}".
+    __CONTAINER_IK_CACHE_PATH = Path("~/.transport_challenge/ik_cache.npz").expanduser()
+
     # Load a list of visual materials for target objects.
-    __TARGET_OBJECT_MATERIALS = TARGET_OBJECT_MATERIALS_PATH.read_text(encoding="utf-8").split("\n")
+    __TARGET_OBJECT_MATERIALS = tuple(TARGET_OBJECT_MATERIALS_PATH.read_text(encoding="utf-8").split("\n"))
+
+    # Load a list of container model names.
+    __CONTAINERS = tuple(CONTAINERS_PATH.read_text(encoding="utf-8").split("\n"))
+
+    # Precomputed container arm reset angles bundled with the module.
+    # Key = model name. Value = {"left": [...], "right": [...]}.
+    # To add entries, copy the solved angles from ~/.transport_challenge/ik_cache.npz after a run.
+    __DEFAULT_CONTAINER_ARM_ANGLES: dict = loads(CONTAINER_ARM_ANGLES_PATH.read_text(encoding="utf-8"))
+
+    # All possible target objects. Key = name. Value = scale.
+    __TARGET_OBJECTS: Dict[str, float] = {row["name"]: float(row["scale"]) for row in
+                                          DictReader(TARGET_OBJECTS_PATH.read_text(encoding="utf-8").splitlines())}
+    __TARGET_OBJECT_NAMES: Tuple[str, ...] = tuple(__TARGET_OBJECTS.keys())
 
     def __init__(self, port: int = 1071, launch_build: bool = False, screen_width: int = 256, screen_height: int = 256,
                  debug: bool = False, auto_save_images: bool = False, images_directory: str = "images",
@@ -134,14 +166,21 @@ class Transport(Magnebot):
 
         # Cached IK solution for resetting an arm holding a container.
         self._container_arm_reset_angles: Dict[Arm, np.array] = dict()
-
-        # Get all possible target objects. Key = name. Value = scale.
-        self._target_objects: Dict[str, float] = dict()
-        with open(str(TARGET_OBJECTS_PATH.resolve())) as csvfile:
-            reader = DictReader(csvfile)
-            for row in reader:
-                self._target_objects[row["name"]] = float(row["scale"])
-        self._target_object_names = list(self._target_objects.keys())
+        # Container arm reset angles solved in previous runs. Key = f"{arm.name}_{model_name}".
+        # Seed the cache with the angle table bundled with the module; any angles solved on this machine override it.
+        self._container_ik_cache: Dict[str, np.array] = dict()
+        for model_name in Transport.__DEFAULT_CONTAINER_ARM_ANGLES:
+            for arm_name, angles in Transport.__DEFAULT_CONTAINER_ARM_ANGLES[model_name].items():
+                self._container_ik_cache[f"{arm_name}_{model_name}"] = np.array(angles)
+        if Transport.__CONTAINER_IK_CACHE_PATH.exists():
+            self._container_ik_cache.update(np.load(str(Transport.__CONTAINER_IK_CACHE_PATH.resolve())))
+        # The model name of each container in the scene. Key = object ID.
+        self._container_model_names: Dict[int, str] = dict()
+        # Set views of `self.containers` and `self.target_objects` for fast membership tests.
+        self._container_id_set: Set[int] = set()
+        self._target_object_id_set: Set[int] = set()
+        # The (x, z) world coordinates of every occupancy map position. This is set in `get_scene_init_commands()`.
+        self._occupancy_xz: Optional[np.array] = None
 
     def init_scene(self, scene: str, layout: int, room: int = None, goal_room: int = None) -> ActionStatus:
         """
@@ -162,7 +201,7 @@ class Transport(Magnebot):
         """
 
         # Set the room of the goal.
-        rooms = np.unique(np.load(str(ROOM_MAPS_DIRECTORY.joinpath(f"{scene[0]}.npy").resolve())))
+        rooms = np.unique(np.load(str(ROOM_MAPS_DIRECTORY.joinpath(f"{scene[0]}.npy").resolve()), mmap_mode="r"))
         if goal_room is None:
             self.goal_room = int(self._rng.choice(rooms))
         else:
@@ -233,14 +272,26 @@ class Transport(Magnebot):
         if arm in self._container_arm_reset_angles:
             return super().reset_arm(arm=arm, reset_torso=reset_torso)
 
-        status = super().reset_arm(arm=arm, reset_torso=reset_torso)
+        # If angles for this (arm, container model) were solved in a previous run, skip the solve.
         for object_id in self.state.held[arm]:
+            if object_id in self._container_id_set:
+                key = f"{arm.name}_{self._container_model_names[object_id]}"
+                if key in self._container_ik_cache:
+                    self._container_arm_reset_angles[arm] = self._container_ik_cache[key]
+                    return super().reset_arm(arm=arm, reset_torso=reset_torso)
+
+        status = super().reset_arm(arm=arm, reset_torso=reset_torso)
+        held = self.state.held[arm]
+        # If the arm isn't holding anything, there's no container to orient.
+        if len(held) == 0:
+            return status
+        for object_id in held:
             # If the arm is holding a container, orient the container to be level with the floor.
-            if object_id in self.containers:
-                rot = self.state.object_transforms[object_id].rotation
+            if object_id in self._container_id_set:
+                qx, qy, qz, qw = self.state.object_transforms[object_id].rotation
                 # Source: https://answers.unity.com/questions/416169/finding-pitchrollyaw-from-quaternions.html
-                x_rot = -np.rad2deg(np.arctan2(2 * rot[0] * rot[3] - 2 * rot[1] * rot[2],
-                                               1 - 2 * rot[0] * rot[0] - 2 * rot[2] * rot[2]))
+                x_rot = -np.rad2deg(np.arctan2(2 * (qx * qw - qy * qz),
+                                               1 - 2 * (qx * qx + qz * qz)))
                 if x_rot > 90:
                     x_rot = x_rot - 180
                 elif x_rot > 0:
@@ -271,8 +322,13 @@ class Transport(Magnebot):
                 self._end_action()
 
                 # Cache the arm angles so we can next time immediately reset to this position.
-                self._container_arm_reset_angles[arm] = np.array([np.rad2deg(a) for a in
-                                                                  self._get_initial_angles(arm=arm)[1:-1]])
+                self._container_arm_reset_angles[arm] = np.rad2deg(
+                    np.asarray(self._get_initial_angles(arm=arm)[1:-1], dtype=np.float64))
+                # Persist the angles to disk so that future runs skip the solve.
+                self._container_ik_cache[f"{arm.name}_{self._container_model_names[object_id]}"] = \
+                    self._container_arm_reset_angles[arm]
+                Transport.__CONTAINER_IK_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+                np.savez(str(Transport.__CONTAINER_IK_CACHE_PATH.resolve()), **self._container_ik_cache)
 
                 return status
         return status
@@ -319,7 +375,7 @@ class Transport(Magnebot):
         object_arm = Arm.left if container_arm == Arm.right else Arm.right
         object_id = None
         for o_id in self.state.held[object_arm]:
-            if o_id in self.target_objects:
+            if o_id in self._target_object_id_set:
                 object_id = o_id
         if object_id is None:
             if self._debug:
@@ -328,16 +384,17 @@ class Transport(Magnebot):
             return ActionStatus.not_holding
 
         self._start_action()
-        self._next_frame_commands.append({"$type": "set_immovable",
-                                          "immovable": True})
-        # Move the other arm out of the way.
+        # Get the ID of the elbow of the arm that isn't holding the container.
         if container_arm == Arm.right:
             elbow_id = self.magnebot_static.arm_joints[ArmJoint.elbow_left]
         else:
             elbow_id = self.magnebot_static.arm_joints[ArmJoint.elbow_right]
-        self._next_frame_commands.append({"$type": "set_revolute_target",
-                                          "joint_id": elbow_id,
-                                          "target": 115})
+        # Make the Magnebot immovable and move the other arm out of the way, all in one frame.
+        self._next_frame_commands.extend([{"$type": "set_immovable",
+                                           "immovable": True},
+                                          {"$type": "set_revolute_target",
+                                           "joint_id": elbow_id,
+                                           "target": 115}])
         state = SceneState(resp=self.communicate([]))
         # Bring the container approximately to center.
         ct = {"x": 0.1 * (-1 if container_arm is Arm.right else 1), "y": 0.4, "z": 0.5}
@@ -413,8 +470,6 @@ class Transport(Magnebot):
         # Get all of the objects currently in the container.
         in_container_0 = self._get_objects_in_container(container_id=container_id)
         self._start_action()
-        self._next_frame_commands.append({"$type": "set_immovable",
-                                          "immovable": True})
 
         # Get the joint IDs.
         if container_arm == Arm.right:
@@ -426,8 +481,10 @@ class Transport(Magnebot):
             elbow_id = self.magnebot_static.arm_joints[ArmJoint.elbow_left]
             wrist_id = self.magnebot_static.arm_joints[ArmJoint.wrist_left]
 
-        # Extend the arm.
-        self._next_frame_commands.extend([{"$type": "set_spherical_target",
+        # Make the Magnebot immovable and extend the arm, all in one frame.
+        self._next_frame_commands.extend([{"$type": "set_immovable",
+                                           "immovable": True},
+                                          {"$type": "set_spherical_target",
                                            "joint_id": shoulder_id,
                                            "target": {"x": -90, "y": 0, "z": 0}},
                                           {"$type": "set_revolute_target",
@@ -472,7 +529,7 @@ class Transport(Magnebot):
         held: List[int] = list()
         for arm in self.state.held:
             for object_id in self.state.held[arm]:
-                if object_id in self.target_objects:
+                if object_id in self._target_object_id_set:
                     held.append(object_id)
         # The object must be in the goal zone and on the floor.
         for object_id in self.target_objects:
@@ -519,51 +576,75 @@ class Transport(Magnebot):
         # Clear the list of target objects and containers.
         self.target_objects.clear()
         self.containers.clear()
+        self._container_id_set.clear()
+        self._target_object_id_set.clear()
+        self._container_model_names.clear()
         commands = super().get_scene_init_commands(scene=scene, layout=layout, audio=audio)
 
         # Load the map of the rooms in the scene, the occupancy map, and the scene bounds.
-        room_map = np.load(str(ROOM_MAPS_DIRECTORY.joinpath(f"{scene[0]}.npy").resolve()))
-        self.occupancy_map = np.load(str(OCCUPANCY_MAPS_DIRECTORY.joinpath(f"{scene[0]}_{layout}.npy").resolve()))
-        self._scene_bounds = loads(SCENE_BOUNDS_PATH.read_text())[scene[0]]
+        # The maps are read-only, so memory-map them instead of copying them into RAM.
+        room_map = np.load(str(ROOM_MAPS_DIRECTORY.joinpath(f"{scene[0]}.npy").resolve()), mmap_mode="r")
+        self.occupancy_map = np.load(str(OCCUPANCY_MAPS_DIRECTORY.joinpath(f"{scene[0]}_{layout}.npy").resolve()),
+                                     mmap_mode="r")
+        self._scene_bounds = _SCENE_BOUNDS[scene[0]]
+
+        # Precompute the (x, z) world coordinates of every occupancy map position with one broadcast
+        # instead of calling `get_occupancy_position()` per placed object.
+        # The mapping is linear in each axis, so derive it from the first two grid positions.
+        x_0, z_0 = self.get_occupancy_position(0, 0)
+        x_1, z_1 = self.get_occupancy_position(1, 1)
+        xs = x_0 + (x_1 - x_0) * np.arange(self.occupancy_map.shape[0])
+        zs = z_0 + (z_1 - z_0) * np.arange(self.occupancy_map.shape[1])
+        self._occupancy_xz = np.stack(np.meshgrid(xs, zs, indexing="ij"), axis=-1)
 
         # Sort all free positions on the occupancy map by room.
-        rooms: Dict[int, List[Tuple[int, int]]] = dict()
-        for ix, iy in np.ndindex(room_map.shape):
-            room_index = room_map[ix][iy]
-            if room_index not in rooms:
-                rooms[room_index] = list()
-            if self.occupancy_map[ix][iy] == 0:
-                rooms[room_index].append((ix, iy))
+        # This bucketing is done in NumPy rather than by iterating over every grid cell.
+        # Rooms without any free positions are excluded.
+        ixs, iys = np.where(self.occupancy_map == 0)
+        room_ids = room_map[ixs, iys]
+        order = np.argsort(room_ids)
+        unique_ids, first_indices = np.unique(room_ids[order], return_index=True)
+        coords = np.stack([ixs, iys], axis=1)[order]
+        # Room IDs are small non-negative ints, so index the buckets by room ID instead of using a dict.
+        rooms: List[np.array] = [np.empty((0, 2), dtype=np.int32) for _ in range(int(room_map.max()) + 1)]
+        for room_id, positions in zip(unique_ids, np.split(coords, first_indices[1:])):
+            rooms[int(room_id)] = positions
+        # The IDs of every room with free positions.
+        room_indices = [i for i in range(len(rooms)) if len(rooms[i]) > 0]
         # Choose a random room.
-        target_room_index = self._rng.choice(np.array(list(rooms.keys())))
-        target_room_positions: np.array = np.array(rooms[target_room_index])
+        target_room_index = self._rng.choice(room_indices)
+        target_room_positions: np.array = rooms[target_room_index]
         used_target_object_positions: List[Tuple[int, int]] = list()
 
         # Add target objects to the room.
-        for i in range(self._rng.randint(8, 12)):
-            got_position = False
-            ix, iy = -1, -1
-            # Get a position where there isn't a target object.
-            while not got_position:
-                ix, iy = target_room_positions[self._rng.randint(0, len(target_room_positions))]
-                got_position = True
-                for utop in used_target_object_positions:
-                    if utop[0] == ix and utop[1] == iy:
-                        got_position = False
-            used_target_object_positions.append((ix, iy))
-            # Get the (x, z) coordinates for this position.
-            x, z = self.get_occupancy_position(ix, iy)
-            self._add_target_object(model_name=self._rng.choice(self._target_object_names),
-                                    position={"x": x, "y": 0, "z": z})
-
-        # Add containers throughout the scene.
-        containers = CONTAINERS_PATH.read_text(encoding="utf-8").split("\n")
-        for room_index in list(rooms.keys()):
+        # Draw all of the random samples in one call each.
+        # Sampling the position indices without replacement guarantees that the positions are distinct.
+        num_target_objects = self._rng.randint(8, 12)
+        position_indices = self._rng.choice(len(target_room_positions), size=num_target_objects, replace=False)
+        model_names = self._rng.choice(Transport.__TARGET_OBJECT_NAMES, size=num_target_objects)
+        rotations = self._rng.uniform(-179, 179, size=num_target_objects)
+        visual_materials = self._rng.choice(Transport.__TARGET_OBJECT_MATERIALS, size=num_target_objects)
+        # Get the (x, z) coordinates of each position and build all of the position dicts in one pass.
+        target_object_coords = target_room_positions[position_indices]
+        xzs = self._occupancy_xz[target_object_coords[:, 0], target_object_coords[:, 1]]
+        positions = [{"x": float(xzs[i][0]), "y": 0, "z": float(xzs[i][1])} for i in range(num_target_objects)]
+        for i in range(num_target_objects):
+            used_target_object_positions.append((target_object_coords[i][0], target_object_coords[i][1]))
+            self._add_target_object(model_name=str(model_names[i]),
+                                    position=positions[i],
+                                    rotation={"x": 0, "y": rotations[i], "z": 0},
+                                    visual_material=str(visual_materials[i]))
+
+        # Add containers throughout the scene. Draw all of the per-room samples in one call each.
+        spawn_rolls = self._rng.random(len(room_indices))
+        container_names = self._rng.choice(Transport.__CONTAINERS, size=len(room_indices))
+        container_rotations = self._rng.uniform(-179, 179, size=len(room_indices))
+        for i, room_index in enumerate(room_indices):
             # Maybe don't add a container in this room.
-            if self._rng.random() < 0.25:
+            if spawn_rolls[i] < 0.25:
                 continue
             # Get a random position in the room.
-            room_positions: np.array = np.array(rooms[room_index])
+            room_positions: np.array = rooms[room_index]
             got_position = False
             ix, iy = -1, -1
             # Get a position where there isn't a target object.
@@ -574,11 +655,10 @@ class Transport(Magnebot):
                     if utop[0] == ix and utop[1] == iy:
                         got_position = False
             # Get the (x, z) coordinates for this position.
-            x, z = self.get_occupancy_position(ix, iy)
-            container_name = self._rng.choice(containers)
-            self._add_container(model_name=container_name,
+            x, z = self._occupancy_xz[ix, iy]
+            self._add_container(model_name=str(container_names[i]),
                                 position={"x": x, "y": 0, "z": z},
-                                rotation={"x": 0, "y": self._rng.uniform(-179, 179), "z": 0})
+                                rotation={"x": 0, "y": container_rotations[i], "z": 0})
         return commands
 
     def _cache_static_data(self, resp: List[bytes]) -> None:
@@ -605,13 +685,15 @@ class Transport(Magnebot):
                                      audio=self._OBJECT_AUDIO[model_name],
                                      model_name=model_name)
         self.containers.append(object_id)
-        # Set a light mass for each container.
-        self._object_init_commands[object_id].append({"$type": "set_mass",
-                                                      "id": object_id,
-                                                      "mass": Transport.__CONTAINER_MASS})
-        # Add a trigger collider inside the container.
-        # We'll use this trigger collider to determine if an object is in the container..
-        self._object_init_commands[object_id].extend([{"$type": "add_trigger_collider",
+        self._container_id_set.add(object_id)
+        self._container_model_names[object_id] = model_name
+        # Set a light mass for each container and add a trigger collider inside the container.
+        # We'll use the trigger collider to determine if an object is in the container.
+        # Add both commands with a single extend.
+        self._object_init_commands[object_id].extend([{"$type": "set_mass",
+                                                       "id": object_id,
+                                                       "mass": Transport.__CONTAINER_MASS},
+                                                      {"$type": "add_trigger_collider",
                                                        "id": object_id,
                                                        "shape": "cube",
                                                        "enter": True,
@@ -621,30 +703,43 @@ class Transport(Magnebot):
                                                        "scale": {"x": 0.457, "y": 0.305, "z": 0.457}}])
         return object_id
 
-    def _add_target_object(self, model_name: str, position: Dict[str, float]) -> int:
+    def _add_target_object(self, model_name: str, position: Dict[str, float],
+                           rotation: Dict[str, float] = None, visual_material: str = None) -> int:
         """
         Add a targt object. Cache  the ID.
 
         :param model_name: The name of the target object.
         :param position: The initial position of the target object.
+        :param rotation: The initial rotation of the target object. If None, a random y rotation.
+        :param visual_material: The visual material of the target object. If None, a random material.
 
         :return: The ID of the target object.
         """
+        if rotation is None:
+            rotation = {"x": 0, "y": self._rng.uniform(-179, 179), "z": 0}
+        if visual_material is None:
+            visual_material = self._rng.choice(Transport.__TARGET_OBJECT_MATERIALS)
         # Set custom object info for the target objects.
-        audio = ObjectInfo(name=model_name, mass=Transport.TARGET_OBJECT_MASS,
-                           material=AudioMaterial.ceramic, resonance=0.6, amp=0.01, library="models_core.json",
-                           bounciness=0.5)
-        scale = self._target_objects[model_name]
+        audio = Transport.__AUDIO_CACHE.get(model_name)
+        if audio is None:
+            audio = ObjectInfo(name=model_name, mass=Transport.TARGET_OBJECT_MASS,
+                               material=AudioMaterial.ceramic, resonance=0.6, amp=0.01, library="models_core.json",
+                               bounciness=0.5)
+            Transport.__AUDIO_CACHE[model_name] = audio
+        scale = Transport.__TARGET_OBJECTS[model_name]
         # Add the object.
         object_id = self._add_object(position=position,
-                                     rotation={"x": 0, "y": self._rng.uniform(-179, 179), "z": 0},
+                                     rotation=rotation,
                                      scale={"x": scale, "y": scale, "z": scale},
                                      audio=audio,
                                      model_name=model_name)
         self.target_objects.append(object_id)
-        # Set a random visual material for each target object.
-        visual_material = self._rng.choice(Transport.__TARGET_OBJECT_MATERIALS)
-        substructure = Transport.__LIBRARIAN.get_record(model_name).substructure
+        self._target_object_id_set.add(object_id)
+        # Set the visual material of the target object.
+        substructure = Transport.__SUBSTRUCTURE_CACHE.get(model_name)
+        if substructure is None:
+            substructure = Transport.__LIBRARIAN.get_record(model_name).substructure
+            Transport.__SUBSTRUCTURE_CACHE[model_name] = substructure
         self._object_init_commands[object_id].extend(TDWUtils.set_visual_material(substructure=substructure,
                                                                                   material=visual_material,
                                                                                   object_id=object_id,
@@ -669,7 +764,7 @@ class Transport(Magnebot):
         # Get an arm holding a container.
         for arm in self.state.held:
             for o_id in self.state.held[arm]:
-                if container_arm is None and o_id in self.containers:
+                if container_arm is None and o_id in self._container_id_set:
                     container_id = o_id
                     container_arm = arm
         return container_arm, container_id
@@ -706,7 +801,7 @@ class Transport(Magnebot):
                 max_y = s[1]
         sides = [np.array((s[0], max_y, s[2])) for s in sides]
         # Don't try to pick up the top or bottom of a container.
-        if target in self.containers:
+        if target in self._container_id_set:
             sides = sides[:-2]
 
         return sides, resp